@@ -0,0 +1,88 @@
+"""Микробенчмарк декодирования заголовков и форматирования дат.
+
+Запуск:
+    python bench_headers.py              # встроенный набор заголовков
+    python bench_headers.py inbox.mbox   # заголовки From/Subject/Date из mbox-файла
+"""
+import mailbox
+import sys
+import timeit
+
+from mail_headers import DEFAULT_TIMEZONE, _decode_header_cached, _format_email_date_cached, decode_email_header, format_email_date
+
+# Типичные заголовки из рассылок и личной переписки: разные кодировки, битые charset, повторы
+SAMPLE_HEADERS = [
+    '=?utf-8?B?0J/RgNC40LLQtdGCLCDQvNC40YAh?=',
+    '=?UTF-8?Q?=D0=9D=D0=BE=D0=B2=D0=BE=D0=B5_=D0=BF=D0=B8=D1=81=D1=8C=D0=BC=D0=BE?=',
+    '=?koi8-r?B?8NLJ18XU?=',
+    '=?windows-1251?B?z/Do4uXy?= <news@example.ru>',
+    '=?x-unknown?Q?=CF=F0=E8=E2=E5=F2?=',
+    '"GitHub" <noreply@github.com>',
+    '[python-dev] Re: PEP 8 update',
+    '=?utf-8?B?0K/QvdC00LXQutGBLtCc0LDRgNC60LXRgg==?= <noreply@market.yandex.ru>',
+    'Re: Fwd: =?utf-8?Q?=D0=9E=D1=82=D1=87=D1=91=D1=82?= за неделю',
+    'Weekly digest',
+]
+
+SAMPLE_DATES = [
+    'Mon, 5 Feb 2024 10:30:00 +0300',
+    'Tue, 06 Feb 2024 07:15:42 +0000 (UTC)',
+    '6 Feb 2024 23:59:59 -0000',
+    'Wed, 7 Feb 2024 12:00:00 GMT',
+    'Thu, 8 Feb 2024 01:02:03 -0800',
+]
+
+# Рассылки повторяют одни и те же значения тысячи раз
+REPEAT = 500
+
+
+def load_mbox(path):
+    headers, dates = [], []
+    for message in mailbox.mbox(path):
+        for name in ('from', 'subject'):
+            if message[name]:
+                headers.append(str(message[name]))
+        if message['date']:
+            dates.append(str(message['date']))
+    return headers, dates
+
+
+def bench(name, func, number):
+    seconds = timeit.timeit(func, number=number)
+    print(f"{name:<32} {seconds * 1000:8.1f} ms")
+
+
+def main():
+    if len(sys.argv) > 1:
+        headers, dates = load_mbox(sys.argv[1])
+    else:
+        headers, dates = SAMPLE_HEADERS * REPEAT, SAMPLE_DATES * REPEAT
+
+    print(f"Headers: {len(headers)}, dates: {len(dates)}")
+
+    def decode_uncached():
+        for header in headers:
+            _decode_header_cached.__wrapped__(header)
+
+    def decode_cached():
+        for header in headers:
+            decode_email_header(header)
+
+    def format_uncached():
+        for date_str in dates:
+            _format_email_date_cached.__wrapped__(date_str, DEFAULT_TIMEZONE)
+
+    def format_cached():
+        for date_str in dates:
+            format_email_date(date_str)
+
+    bench("decode_email_header (no cache)", decode_uncached, 5)
+    bench("decode_email_header (cached)", decode_cached, 5)
+    bench("format_email_date (no cache)", format_uncached, 5)
+    bench("format_email_date (cached)", format_cached, 5)
+    print(f"Header cache: {_decode_header_cached.cache_info()}")
+    print(f"Date cache: {_format_email_date_cached.cache_info()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,16 @@
+import time
+
+# Засекаем время старта до импорта тяжёлых модулей
+STARTUP_STARTED_AT = time.perf_counter()
+
 import os
+import json
+import hashlib
 import logging
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from dotenv import load_dotenv
@@ -10,23 +18,17 @@ import aiohttp
 import asyncio
 from datetime import datetime
 import sys
-import imaplib
 import email
-from email.header import decode_header
+from email.utils import parseaddr
 import re
-import locale
-import dateparser
 import base64
 from urllib.parse import quote_plus
+from mail_headers import DEFAULT_TIMEZONE, decode_email_header, format_email_date, is_valid_timezone
+from outbox import Outbox
+from mail_attachments import TELEGRAM_UPLOAD_LIMIT, list_attachments, download_attachment
 
-# Устанавливаем русскую локаль с правильной кодировкой
-try:
-    locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
-except:
-    try:
-        locale.setlocale(locale.LC_TIME, 'Russian_Russia.1251')
-    except:
-        logging.warning("Could not set Russian locale")
+# imaplib и smtplib импортируются лениво внутри функций, которые ими пользуются.
+# Русская локаль не нужна: даты форматируются по таблицам DAYS и MONTHS.
 
 # Load environment variables
 load_dotenv()
@@ -34,6 +36,15 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Бюджет на импорт модулей при старте (в миллисекундах)
+STARTUP_IMPORT_BUDGET_MS = float(os.getenv('STARTUP_IMPORT_BUDGET_MS', '500'))
+
+import_time_ms = (time.perf_counter() - STARTUP_STARTED_AT) * 1000
+if import_time_ms > STARTUP_IMPORT_BUDGET_MS:
+    logging.warning(f"Startup imports took {import_time_ms:.0f} ms (budget {STARTUP_IMPORT_BUDGET_MS:.0f} ms)")
+else:
+    logging.info(f"Startup imports took {import_time_ms:.0f} ms (budget {STARTUP_IMPORT_BUDGET_MS:.0f} ms)")
+
 # Get bot token and validate it
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN or BOT_TOKEN == 'your_telegram_bot_token':
@@ -74,44 +85,34 @@ GMAIL_SCOPES = "https://mail.google.com/"  # Полный доступ к Gmail
 # Store user tokens and email credentials
 user_tokens = {}
 user_credentials = {}
-last_email_ids = {}  # Хранение ID последних проверенных писем для каждого пользователя
-
-# Словари для перевода дней недели и месяцев
-DAYS = {
-    'Mon': 'Понедельник',
-    'Tue': 'Вторник',
-    'Wed': 'Среда',
-    'Thu': 'Четверг',
-    'Fri': 'Пятница',
-    'Sat': 'Суббота',
-    'Sun': 'Воскресенье'
-}
-
-MONTHS = {
-    'Jan': 'Января',
-    'Feb': 'Февраля',
-    'Mar': 'Марта',
-    'Apr': 'Апреля',
-    'May': 'Мая',
-    'Jun': 'Июня',
-    'Jul': 'Июля',
-    'Aug': 'Августа',
-    'Sep': 'Сентября',
-    'Oct': 'Октября',
-    'Nov': 'Ноября',
-    'Dec': 'Декабря'
-}
-
-
-def decode_email_header(header):
-    """Декодирует заголовок письма"""
-    decoded = []
-    for part, encoding in decode_header(header):
-        if isinstance(part, bytes):
-            decoded.append(part.decode(encoding or 'utf-8'))
-        else:
-            decoded.append(part)
-    return ''.join(decoded)
+last_email_ids = {}  # UIDVALIDITY входящих и UID последнего проверенного письма для каждого пользователя
+
+# Файл, в котором сохраняются учетные данные между перезапусками
+USERS_FILE = os.getenv('USERS_FILE', 'users.json')
+
+# Восстановление наблюдателей за почтой после перезапуска
+RESTORE_START_DELAY = float(os.getenv('RESTORE_START_DELAY', '2'))  # Пауза перед первой пачкой, секунды
+RESTORE_BATCH_SIZE = int(os.getenv('RESTORE_BATCH_SIZE', '10'))  # Сколько ящиков подключать одновременно
+RESTORE_BATCH_DELAY = float(os.getenv('RESTORE_BATCH_DELAY', '3'))  # Пауза между пачками, секунды
+
+# Режим сводки для загруженных ящиков
+DIGEST_WINDOW = int(os.getenv('DIGEST_WINDOW', '600'))  # Окно накопления писем, секунды
+DIGEST_MAX_ITEMS = 20  # Сколько групп писем показывать в одной сводке
+DIGEST_HEADER_FIELDS = 'FROM SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES'
+
+# Журнал неотправленных уведомлений и писем
+OUTBOX_FILE = os.getenv('OUTBOX_FILE', 'outbox.jsonl')
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '5'))  # Попыток отправить уведомление
+# Общий срок на всю остановку бота, секунды. Он должен быть меньше времени, которое супервизор даёт
+# процессу после SIGTERM (в Docker по умолчанию 10 секунд), иначе процесс будет убит посреди остановки
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '8'))
+
+outbox = Outbox(OUTBOX_FILE)
+shutdown_event = asyncio.Event()
+watcher_tasks = {}  # Задачи проверки почты по пользователям
+mail_deliveries = set()  # Письма, которые отправляются прямо сейчас
+notification_attempts = {}  # Неудачные попытки отправки уведомлений из журнала по ключам
+service_tasks = {}  # Фоновые задачи бота: синхронизация журнала и возобновление работы после запуска
 
 
 def get_email_text(email_message):
@@ -205,138 +206,488 @@ def get_email_text(email_message):
     return '\n\n'.join(paragraphs)
 
 
-def format_email_date(date_str):
-    """Форматирует дату письма в русский формат"""
-    if not date_str:
-        return 'Дата неизвестна'
+PERSISTED_CREDENTIAL_FIELDS = ('email', 'access_token', 'refresh_token', 'service', 'digest', 'vip_senders', 'timezone')
+
+
+def save_user_credentials():
+    """Сохраняет учетные данные пользователей в файл"""
+    data = {
+        str(user_id): {field: credentials.get(field) for field in PERSISTED_CREDENTIAL_FIELDS}
+        for user_id, credentials in user_credentials.items()
+    }
+    try:
+        tmp_path = f"{USERS_FILE}.tmp"
+        # В файле лежат токены доступа, поэтому читать его может только владелец.
+        # Права задаются только при создании файла, так что старый временный файл удаляем
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, USERS_FILE)
+    except Exception as e:
+        logging.error(f"Error saving user credentials: {str(e)}")
+
+
+def load_user_credentials():
+    """Загружает сохраненные учетные данные пользователей"""
+    if not os.path.exists(USERS_FILE):
+        return
+    try:
+        with open(USERS_FILE, encoding='utf-8') as f:
+            data = json.load(f)
+        for user_id, credentials in data.items():
+            user_credentials[int(user_id)] = credentials
+        logging.info(f"Loaded credentials for {len(data)} users")
+    except Exception as e:
+        logging.error(f"Error loading user credentials: {str(e)}")
+
+
+def connect_imap(credentials):
+    """Подключается к IMAP-серверу пользователя и авторизуется через XOAUTH2"""
+    import imaplib
+
+    if credentials['service'] == 'gmail':
+        imap = imaplib.IMAP4_SSL('imap.gmail.com')
+    else:
+        imap = imaplib.IMAP4_SSL('imap.yandex.ru')
+
+    imap.authenticate('XOAUTH2',
+                      lambda x: f"user={credentials['email']}\1auth=Bearer {credentials['access_token']}\1\1")
+    return imap
+
+
+def open_inbox(credentials, mailbox_state=None):
+    """Подключается к ящику и возвращает соединение, UIDVALIDITY и UID писем новее учтенного (блокирующий вызов)"""
+    imap = connect_imap(credentials)
+    try:
+        imap.select('INBOX')
+        _, validity = imap.response('UIDVALIDITY')
+        uidvalidity = validity[0].decode() if validity and validity[0] else ''
+
+        # Работаем с UID: порядковые номера писем сдвигаются при удалении писем из ящика.
+        # Если UIDVALIDITY изменился, прежние UID недействительны и ящик читается заново
+        since_uid = mailbox_state[1] if mailbox_state and mailbox_state[0] == uidvalidity else 0
+        status, messages = imap.uid('SEARCH', None, f'UID {since_uid + 1}:*')
+    except Exception:
+        imap.logout()
+        raise
+
+    if status != 'OK':
+        return imap, uidvalidity, None
+    # Диапазон "n:*" всегда включает последнее письмо, даже если его UID меньше n
+    return imap, uidvalidity, sorted(uid for uid in map(int, messages[0].split()) if uid > since_uid)
+
+
+def fetch_email(imap, uid, query):
+    """Загружает письмо или его заголовки по UID через открытое соединение (блокирующий вызов)"""
+    status, msg_data = imap.uid('FETCH', str(uid), query)
+    if status != 'OK' or not msg_data:
+        return None
+    # Сервер может прислать вместе с ответом уведомления о других письмах без тела
+    for item in msg_data:
+        if isinstance(item, tuple):
+            return email.message_from_bytes(item[1])
+    return None
+
+
+def close_imap(imap):
+    """Закрывает соединение с ящиком (блокирующий вызов)"""
+    try:
+        imap.close()
+    finally:
+        imap.logout()
+
+
+def fetch_inbox_state(credentials):
+    """Возвращает UIDVALIDITY входящих и UID последнего письма в них (блокирующий вызов)"""
+    imap, uidvalidity, uids = open_inbox(credentials)
+    close_imap(imap)
+    return uidvalidity, uids[-1] if uids else 0
+
+
+def fetch_attachment_list(credentials, uid):
+    """Возвращает список вложений письма по UID (блокирующий вызов)"""
+    imap = connect_imap(credentials)
+    try:
+        imap.select('INBOX', readonly=True)
+        return list_attachments(imap, uid)
+    finally:
+        close_imap(imap)
+
+
+def fetch_attachment_file(credentials, uid, attachment):
+    """Скачивает вложение письма с указанным UID во временный файл и возвращает путь к нему (блокирующий вызов)"""
+    imap = connect_imap(credentials)
+    try:
+        imap.select('INBOX', readonly=True)
+        return download_attachment(imap, uid, attachment)
+    finally:
+        close_imap(imap)
+
 
+async def warm_up_watcher(user_id: int):
+    """Запоминает UID текущих писем пользователя, не блокируя event loop"""
     try:
-        # Разбиваем строку даты на части
-        parts = date_str.split()
-        if len(parts) < 5:
-            return date_str
-
-        # Получаем компоненты даты
-        day_of_week = DAYS.get(parts[0].rstrip(','), parts[0])  # Убираем запятую из дня недели
-        day = parts[1]
-        month = MONTHS.get(parts[2], parts[2])
-        year = parts[3]
-        time = parts[4].split(':')[0:2]  # Берем только часы и минуты
-        time_str = ':'.join(time)
-
-        # Формируем дату вручную
-        formatted_date = f"{day_of_week}, {day} {month} {year}, {time_str}"
-        return formatted_date
+        last_email_ids[user_id] = await asyncio.to_thread(fetch_inbox_state, user_credentials[user_id])
+        outbox.checkpoint(user_id, *last_email_ids[user_id])
     except Exception as e:
-        logging.error(f"Error formatting date {date_str}: {str(e)}")
-        return date_str
+        logging.error(f"Error during initial email check for user {user_id}: {str(e)}")
+
+
+def start_watcher(user_id: int):
+    """Запускает проверку почты пользователя, если она еще не запущена"""
+    task = watcher_tasks.get(user_id)
+    if task is None or task.done():
+        watcher_tasks[user_id] = asyncio.create_task(check_emails(user_id))
+
+
+async def restore_watchers():
+    """Поднимает наблюдателей за почтой после перезапуска параллельными пачками с паузами"""
+    user_ids = list(user_credentials)
+    if not user_ids:
+        return
+
+    # Даем боту сначала ответить на первые обновления из Telegram
+    await asyncio.sleep(RESTORE_START_DELAY)
+
+    started_at = time.perf_counter()
+    for i in range(0, len(user_ids), RESTORE_BATCH_SIZE):
+        batch = [user_id for user_id in user_ids[i:i + RESTORE_BATCH_SIZE] if user_id in user_credentials]
+        # Пользователи, чьи письма уже учтены в журнале, не требуют начальной проверки
+        await asyncio.gather(*(warm_up_watcher(user_id) for user_id in batch if user_id not in last_email_ids))
+        for user_id in batch:
+            start_watcher(user_id)
+        logging.info(f"Restored watchers {i + 1}-{i + len(batch)} of {len(user_ids)}")
+
+        if i + RESTORE_BATCH_SIZE < len(user_ids):
+            await asyncio.sleep(RESTORE_BATCH_DELAY)
+
+    logging.info(f"Restored {len(user_ids)} watchers in {time.perf_counter() - started_at:.1f} s")
+
+
+def build_email_notification(user_id: int, uid: int, email_message):
+    """Собирает уведомление о письме в виде, пригодном для записи в журнал"""
+    subject = decode_email_header(email_message['subject'] or 'Без темы')
+    from_addr = decode_email_header(email_message['from'] or 'Неизвестно')
+    date_str = email_message['date']
+    date = format_email_date(date_str, user_credentials[user_id].get('timezone', DEFAULT_TIMEZONE))
+    full_text = get_email_text(email_message)
+
+    short_text = full_text[:200] + "..." if len(full_text) > 200 else full_text
+
+    has_attachments = any(
+        part.get_filename() or 'attachment' in str(part.get('Content-Disposition'))
+        for part in email_message.walk() if not part.is_multipart()
+    )
+
+    return {
+        'user_id': user_id,
+        'email_id': f"{user_id}_{uid}",
+        'has_attachments': has_attachments,
+        'email_data': {
+            'full_text': full_text,
+            'short_text': short_text,
+            'from_addr': from_addr,
+            'subject': subject,
+            'date': date
+        }
+    }
+
+
+async def send_notification(user_id: int, notification):
+    """Сохраняет текст письма и отправляет уведомление о нём с клавиатурой"""
+    email_id = notification['email_id']
+    email_data = notification['email_data']
+
+    keyboard_rows = [
+        [InlineKeyboardButton(
+            text="📖 Показать полностью",
+            callback_data=f"show_full_{email_id}"
+        )],
+        [InlineKeyboardButton(
+            text="✉️ Ответить",
+            callback_data=f"reply_to_{email_id}"
+        )]
+    ]
+    if notification['has_attachments']:
+        keyboard_rows.append([InlineKeyboardButton(
+            text="📎 Вложения",
+            callback_data=f"attachments_{email_id}"
+        )])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
+
+    message_text = (
+        f"📧 Новое письмо:\n"
+        f"От: {email_data['from_addr']}\n"
+        f"Тема: {email_data['subject']}\n"
+        f"Дата: {email_data['date']}\n\n"
+        f"Текст письма:\n{email_data['short_text']}"
+    )
+
+    if 'email_texts' not in user_credentials[user_id]:
+        user_credentials[user_id]['email_texts'] = {}
+    user_credentials[user_id]['email_texts'][email_id] = email_data
+
+    await bot.send_message(user_id, message_text, reply_markup=keyboard)
+
+
+async def deliver_notification(key: str, user_id: int, notification):
+    """Отправляет уведомление из журнала и отмечает его отправленным.
+
+    При временной ошибке уведомление остается в журнале и повторяется при следующей проверке почты.
+    Если бот заблокирован или запрос отклонен, а также после NOTIFICATION_MAX_ATTEMPTS попыток,
+    уведомление снимается с очереди, чтобы не повторяться при каждом запуске.
+    """
+    try:
+        await send_notification(user_id, notification)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logging.error(f"Dropping notification {key}: {str(e)}")
+        notification_attempts.pop(key, None)
+        outbox.complete(key)
+        return False
+    except Exception as e:
+        attempts = notification_attempts.get(key, 0) + 1
+        if attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            logging.error(f"Dropping notification {key} after {attempts} attempts: {str(e)}")
+            notification_attempts.pop(key, None)
+            outbox.complete(key)
+        else:
+            logging.warning(f"Error sending notification {key} (attempt {attempts}): {str(e)}")
+            notification_attempts[key] = attempts
+        return False
+
+    notification_attempts.pop(key, None)
+    outbox.complete(key)
+    return True
+
+
+async def retry_notifications(user_id: int):
+    """Повторяет уведомления пользователя, которые не удалось отправить раньше, от старых к новым"""
+    for key, entry in list(outbox.pending.items()):
+        if entry['kind'] == 'notification' and entry['payload']['user_id'] == user_id:
+            await deliver_notification(key, user_id, entry['payload'])
+
+
+def fetch_email_message(credentials, uid):
+    """Загружает письмо целиком по UID (блокирующий вызов)"""
+    imap = connect_imap(credentials)
+    try:
+        imap.select('INBOX', readonly=True)
+        return fetch_email(imap, uid, '(RFC822)')
+    finally:
+        close_imap(imap)
+
+
+def is_vip_sender(credentials, from_header):
+    """Проверяет, входит ли отправитель в VIP-список (адрес или @домен)"""
+    vip_senders = credentials.get('vip_senders') or []
+    if not vip_senders or not from_header:
+        return False
+    address = parseaddr(str(from_header))[1].lower()
+    domain = '@' + address.rsplit('@', 1)[-1]
+    return address in vip_senders or domain in vip_senders
+
+
+def normalize_subject(subject):
+    """Убирает из темы префиксы Re:/Fwd: и лишние пробелы"""
+    subject = re.sub(r'^\s*((re|fwd?|ответ|пересл)\s*(\[\d+\])?\s*:\s*)+', '', subject, flags=re.IGNORECASE)
+    return ' '.join(subject.split()).lower()
+
+
+def make_digest_item(uid: int, headers):
+    """Извлекает из заголовков письма то, что нужно сводке, в виде, пригодном для журнала"""
+    references = str(headers['references'] or '').split()
+    return {
+        'uid': uid,
+        'from_addr': decode_email_header(headers['from'] or 'Неизвестно'),
+        'subject': decode_email_header(headers['subject'] or 'Без темы'),
+        'message_id': str(headers['message-id'] or '').strip(),
+        'parent': references[0] if references else str(headers['in-reply-to'] or '').strip()
+    }
+
+
+def add_to_digest(user_id: int, journal_key: str, item):
+    """Добавляет письмо в сводку, объединяя его с письмами той же ветки или того же отправителя и темы"""
+    pending = user_credentials[user_id].setdefault('digest_pending', {
+        'started_at': time.time(),
+        'groups': {},
+        'aliases': {},  # Message-ID или отправитель с темой -> ключ группы
+        'message_ids': set(),
+        'keys': []  # Ключи журнала, которые будут отмечены после отправки сводки
+    })
+    pending['keys'].append(journal_key)
+
+    uid = item['uid']
+    message_id = item['message_id']
+    if message_id and message_id in pending['message_ids']:
+        # Та же копия письма пришла повторно (например, через несколько рассылок)
+        return
+    if message_id:
+        pending['message_ids'].add(message_id)
+
+    subject = item['subject']
+    from_addr = item['from_addr']
+    parent = item['parent']
+    aliases = pending['aliases']
+
+    if parent:
+        # Ответ попадает в группу начала ветки, даже если оно еще не пришло
+        key = aliases.setdefault(parent, parent)
+    else:
+        # Начало ветки группируем по своему Message-ID, а похожие письма рассылок - по отправителю и теме
+        sender = parseaddr(from_addr)[1].lower() or from_addr
+        sender_key = f"{sender}\n{normalize_subject(subject)}"
+        key = aliases.get(message_id) or aliases.get(sender_key) or message_id or sender_key
+        aliases[sender_key] = key
+    if message_id:
+        aliases.setdefault(message_id, key)
+
+    group = pending['groups'].get(key)
+    if group is None:
+        pending['groups'][key] = {
+            'from_addr': from_addr,
+            'subject': subject,
+            'count': 1,
+            'uid': uid
+        }
+    else:
+        group['count'] += 1
+        if not parent and key == message_id:
+            # Группу, начатую ответом, подписываем отправителем и темой начала ветки
+            group['from_addr'] = from_addr
+            group['subject'] = subject
+        if uid > group['uid']:
+            group['uid'] = uid  # Показываем самое свежее письмо группы
+
+
+async def send_digest(user_id: int):
+    """Отправляет накопленную сводку одним сообщением"""
+    pending = user_credentials[user_id].pop('digest_pending', None)
+    if not pending:
+        return
+    if not pending['groups']:
+        for key in pending['keys']:
+            outbox.complete(key)
+        return
+
+    groups = list(pending['groups'].values())
+    total = sum(group['count'] for group in groups)
+
+    lines = [f"📬 Сводка: новых писем - {total}\n"]
+    buttons = []
+    for i, group in enumerate(groups[:DIGEST_MAX_ITEMS], start=1):
+        count = f" (×{group['count']})" if group['count'] > 1 else ""
+        lines.append(f"{i}. {group['from_addr']} - {group['subject']}{count}")
+        buttons.append(InlineKeyboardButton(
+            text=f"📖 {i}",
+            callback_data=f"digest_show_{user_id}_{group['uid']}"
+        ))
+    if len(groups) > DIGEST_MAX_ITEMS:
+        lines.append(f"\n...и ещё {len(groups) - DIGEST_MAX_ITEMS}")
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 5] for i in range(0, len(buttons), 5)])
+    await send_long_message(user_id, '\n'.join(lines), keyboard)
+    for key in pending['keys']:
+        outbox.complete(key)
+    logging.info(f"Sent digest with {total} emails to user {user_id}")
 
 
 async def check_emails(user_id: int):
     logging.info(f"Starting email check for user {user_id}")
 
     if user_id not in last_email_ids:
-        last_email_ids[user_id] = set()
-        try:
-            credentials = user_credentials[user_id]
-            if credentials['service'] == 'gmail':
-                imap = imaplib.IMAP4_SSL('imap.gmail.com')
-                imap.authenticate('XOAUTH2', lambda
-                    x: f"user={credentials['email']}\1auth=Bearer {credentials['access_token']}\1\1")
-            else:
-                imap = imaplib.IMAP4_SSL('imap.yandex.ru')
-                imap.authenticate('XOAUTH2', lambda
-                    x: f"user={credentials['email']}\1auth=Bearer {credentials['access_token']}\1\1")
-
-            imap.select('INBOX')
-            status, messages = imap.search(None, 'ALL')
-            if status == 'OK':
-                last_email_ids[user_id] = set(messages[0].split())
-            imap.close()
-            imap.logout()
-        except Exception as e:
-            logging.error(f"Error during initial email check: {str(e)}")
+        await warm_up_watcher(user_id)
+
+    while user_id in user_credentials and not shutdown_event.is_set():
+        # Сначала уведомления, отправка которых не удалась, чтобы они шли раньше новых
+        await retry_notifications(user_id)
 
-    while user_id in user_credentials:
         try:
             credentials = user_credentials[user_id]
-            if credentials['service'] == 'gmail':
-                imap = imaplib.IMAP4_SSL('imap.gmail.com')
-            else:
-                imap = imaplib.IMAP4_SSL('imap.yandex.ru')
-
-            imap.authenticate('XOAUTH2',
-                              lambda x: f"user={credentials['email']}\1auth=Bearer {credentials['access_token']}\1\1")
-            imap.select('INBOX')
-            status, messages = imap.search(None, 'ALL')
+            mailbox_state = last_email_ids.get(user_id)
+            # Все обращения к IMAP выполняются в отдельных потоках, чтобы не задерживать обновления Telegram
+            imap, uidvalidity, new_ids = await asyncio.to_thread(open_inbox, credentials, mailbox_state)
 
-            if status == 'OK':
-                current_ids = set(messages[0].split())
-                new_ids = current_ids - last_email_ids[user_id]
+            try:
+                if new_ids is not None and (mailbox_state is None or mailbox_state[0] != uidvalidity):
+                    # Начальная проверка не удалась или ящик пересоздан: запоминаем текущие письма без уведомлений
+                    last_email_ids[user_id] = (uidvalidity, new_ids[-1] if new_ids else 0)
+                    outbox.checkpoint(user_id, *last_email_ids[user_id])
+                elif new_ids:
+                    interrupted = False
+                    # В режиме сводки письма идут от старых к новым, чтобы ответы попадали в группы своих веток
+                    ordered_ids = list(new_ids) if credentials.get('digest') else list(reversed(new_ids))
+
+                    for uid in ordered_ids:
+                        # При остановке бота необработанные письма останутся новыми и будут обработаны после запуска,
+                        # а уже обработанные отсеются по ключам журнала
+                        if shutdown_event.is_set():
+                            interrupted = True
+                            break
 
-                if new_ids:
-                    for msg_id in reversed(sorted(new_ids)):
                         try:
-                            status, msg_data = imap.fetch(msg_id, '(RFC822)')
-                            if status == 'OK':
-                                email_body = msg_data[0][1]
-                                email_message = email.message_from_bytes(email_body)
-
-                                subject = decode_email_header(email_message['subject'] or 'Без темы')
-                                from_addr = decode_email_header(email_message['from'] or 'Неизвестно')
-                                date_str = email_message['date']
-                                date = format_email_date(date_str) if date_str else 'Дата неизвестна'
-                                full_text = get_email_text(email_message)
-
-                                short_text = full_text[:200] + "..." if len(full_text) > 200 else full_text
-
-                                email_id = f"{user_id}_{msg_id.decode()}"
-
-                                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(
-                                        text="📖 Показать полностью",
-                                        callback_data=f"show_full_{email_id}"
-                                    )],
-                                    [InlineKeyboardButton(
-                                        text="✉️ Ответить",
-                                        callback_data=f"reply_to_{email_id}"
-                                    )]
-                                ])
-
-                                message_text = (
-                                    f"📧 Новое письмо:\n"
-                                    f"От: {from_addr}\n"
-                                    f"Тема: {subject}\n"
-                                    f"Дата: {date}\n\n"
-                                    f"Текст письма:\n{short_text}"
+                            if credentials.get('digest'):
+                                # Для сводки достаточно заголовков, тело письма загружается по кнопке
+                                headers = await asyncio.to_thread(
+                                    fetch_email, imap, uid, f'(BODY.PEEK[HEADER.FIELDS ({DIGEST_HEADER_FIELDS})])'
                                 )
-
-                                if 'email_texts' not in user_credentials[user_id]:
-                                    user_credentials[user_id]['email_texts'] = {}
-                                user_credentials[user_id]['email_texts'][email_id] = {
-                                    'full_text': full_text,
-                                    'short_text': short_text,
-                                    'from_addr': from_addr,
-                                    'subject': subject,
-                                    'date': date
-                                }
-
-                                await bot.send_message(user_id, message_text, reply_markup=keyboard)
-                                logging.info(f"Sent notification about new email to user {user_id}")
+                                if headers is not None and not is_vip_sender(credentials, headers['from']):
+                                    message_key = str(headers['message-id'] or uid).strip()
+                                    key = f"digest:{user_id}:{message_key}"
+                                    if outbox.is_known(key):
+                                        continue
+
+                                    item = make_digest_item(uid, headers)
+                                    outbox.add(key, 'digest', {'user_id': user_id, 'item': item})
+                                    add_to_digest(user_id, key, item)
+                                    continue
+
+                            email_message = await asyncio.to_thread(fetch_email, imap, uid, '(RFC822)')
+                            if email_message is not None:
+                                # Ключ по Message-ID не дает отправить одно уведомление дважды
+                                message_key = str(email_message['message-id'] or uid).strip()
+                                key = f"notify:{user_id}:{message_key}"
+                                if outbox.is_known(key):
+                                    continue
+
+                                notification = await asyncio.to_thread(
+                                    build_email_notification, user_id, uid, email_message
+                                )
+                                # В журнал попадает только краткий текст, полный загружается заново по кнопке
+                                email_data = {k: v for k, v in notification['email_data'].items() if k != 'full_text'}
+                                outbox.add(key, 'notification', {**notification, 'email_data': email_data})
+                                if await deliver_notification(key, user_id, notification):
+                                    logging.info(f"Sent notification about new email to user {user_id}")
                         except Exception as e:
-                            logging.error(f"Error processing email {msg_id}: {str(e)}")
+                            logging.error(f"Error processing email {uid}: {str(e)}")
                             continue
 
-                last_email_ids[user_id] = current_ids
-
-            imap.close()
-            imap.logout()
+                    if not interrupted:
+                        last_email_ids[user_id] = (uidvalidity, new_ids[-1])
+                        outbox.checkpoint(user_id, *last_email_ids[user_id])
+            finally:
+                await asyncio.to_thread(close_imap, imap)
 
         except Exception as e:
             logging.error(f"Error checking emails for user {user_id}: {str(e)}")
             await bot.send_message(user_id, f"❌ Произошла ошибка при проверке почты: {str(e)}")
 
-        await asyncio.sleep(30)
+        # Сводку отправляем по истечении окна или сразу, если режим сводки выключили,
+        # даже если проверка почты не удалась: собранные письма не должны ждать восстановления IMAP
+        try:
+            credentials = user_credentials.get(user_id, {})
+            pending = credentials.get('digest_pending')
+            if pending and (not credentials.get('digest') or time.time() - pending['started_at'] >= DIGEST_WINDOW):
+                await send_digest(user_id)
+        except Exception as e:
+            logging.error(f"Error sending digest to user {user_id}: {str(e)}")
+
+        # Ждем следующую проверку, но просыпаемся сразу при остановке бота
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            pass
 
 
 @dp.message(Command("start"))
@@ -432,6 +783,7 @@ async def process_auth_code(message: types.Message, state: FSMContext):
                                     'refresh_token': token_data.get('refresh_token'),
                                     'service': 'gmail' if 'gmail' in message.text.lower() else 'yandex'
                                 }
+                                save_user_credentials()
 
                                 await message.answer(
                                     "✅ Авторизация успешна! Теперь я буду проверять вашу почту."
@@ -439,7 +791,7 @@ async def process_auth_code(message: types.Message, state: FSMContext):
                                 await state.clear()
 
                                 # Start email checking loop
-                                asyncio.create_task(check_emails(message.from_user.id))
+                                start_watcher(message.from_user.id)
                             else:
                                 await message.answer(
                                     "❌ Не удалось определить email пользователя. "
@@ -517,6 +869,15 @@ async def show_full_email(callback: types.CallbackQuery):
                 user_credentials[user_id]['email_texts']:
             email_data = user_credentials[user_id]['email_texts'][email_id]
 
+            # После перезапуска в журнале остается только краткий текст, полный загружаем заново
+            if 'full_text' not in email_data:
+                uid = email_id.split('_', 1)[1]
+                email_message = await asyncio.to_thread(fetch_email_message, user_credentials[user_id], uid)
+                if email_message is None:
+                    await callback.answer("❌ Текст письма не найден", show_alert=True)
+                    return
+                email_data['full_text'] = await asyncio.to_thread(get_email_text, email_message)
+
             # Формируем сообщение с полным текстом
             full_message = (
                 f"📧 Письмо:\n"
@@ -587,6 +948,265 @@ async def hide_full_email(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка при скрытии письма", show_alert=True)
 
 
+async def get_email_attachments(user_id: int, email_id: str):
+    """Возвращает список вложений письма, запрашивая BODYSTRUCTURE только при первом обращении"""
+    attachments = user_credentials[user_id].setdefault('attachments', {})
+    if email_id in attachments:
+        return attachments[email_id]
+
+    uid = email_id.split('_', 1)[1]
+    result = await asyncio.to_thread(fetch_attachment_list, user_credentials[user_id], uid)
+    # Пустой список не кэшируем: письмо могло ещё не синхронизироваться на сервере
+    if result:
+        attachments[email_id] = result
+    return result
+
+
+@dp.callback_query(F.data.startswith("attachments_"))
+async def show_attachments(callback: types.CallbackQuery):
+    try:
+        email_id = callback.data.replace("attachments_", "")
+        user_id = callback.from_user.id
+
+        if user_id not in user_credentials:
+            await callback.answer("❌ Письмо не найдено", show_alert=True)
+            return
+
+        attachments = await get_email_attachments(user_id, email_id)
+        if not attachments:
+            await callback.answer("❌ Вложения не найдены", show_alert=True)
+            return
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(
+                text=f"📎 {attachment['filename']}",
+                callback_data=f"send_attachment_{email_id}_{attachment['part']}"
+            )]
+            for attachment in attachments
+        ])
+        await callback.message.answer("Выберите вложение:", reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        logging.error(f"Error listing attachments: {str(e)}")
+        await callback.answer("❌ Произошла ошибка при получении вложений", show_alert=True)
+
+
+@dp.callback_query(F.data.startswith("send_attachment_"))
+async def send_attachment(callback: types.CallbackQuery):
+    email_id, part = callback.data.replace("send_attachment_", "").rsplit('_', 1)
+    user_id = callback.from_user.id
+
+    if user_id not in user_credentials:
+        await callback.answer("❌ Письмо не найдено", show_alert=True)
+        return
+
+    # Telegram хранит загруженные файлы, поэтому повторно отправляем только file_id
+    file_ids = user_credentials[user_id].setdefault('attachment_file_ids', {})
+    cache_key = f"{email_id}_{part}"
+    if cache_key in file_ids:
+        try:
+            await bot.send_document(user_id, file_ids[cache_key])
+            await callback.answer()
+            return
+        except Exception as e:
+            # file_id мог устареть - забываем его и загружаем вложение заново
+            logging.error(f"Error sending cached attachment: {str(e)}")
+            del file_ids[cache_key]
+
+    try:
+        attachments = await get_email_attachments(user_id, email_id)
+        attachment = next((a for a in attachments if a['part'] == part), None)
+        if attachment is None:
+            await callback.answer("❌ Вложение не найдено", show_alert=True)
+            return
+
+        # В BODYSTRUCTURE указан размер в закодированном виде
+        size = attachment['size'] * 3 // 4 if attachment['encoding'] == 'base64' else attachment['size']
+        if size > TELEGRAM_UPLOAD_LIMIT:
+            await callback.answer("❌ Вложение слишком большое для Telegram (больше 50 МБ)", show_alert=True)
+            return
+    except Exception as e:
+        logging.error(f"Error preparing attachment: {str(e)}")
+        await callback.answer("❌ Произошла ошибка при получении вложения", show_alert=True)
+        return
+
+    await callback.answer("⏳ Загружаю вложение...")
+
+    path = None
+    try:
+        uid = email_id.split('_', 1)[1]
+        path = await asyncio.to_thread(fetch_attachment_file, user_credentials[user_id], uid, attachment)
+        sent = await bot.send_document(user_id, FSInputFile(path, filename=attachment['filename']))
+        file_ids[cache_key] = sent.document.file_id
+    except Exception as e:
+        logging.error(f"Error sending attachment: {str(e)}")
+        await bot.send_message(user_id, f"❌ Не удалось отправить вложение: {e}")
+    finally:
+        if path:
+            os.remove(path)
+
+
+@dp.callback_query(F.data.startswith("digest_show_"))
+async def show_digest_email(callback: types.CallbackQuery):
+    try:
+        user_id = callback.from_user.id
+        uid = callback.data.replace(f"digest_show_{user_id}_", "")
+
+        if user_id not in user_credentials:
+            await callback.answer("❌ Письмо не найдено", show_alert=True)
+            return
+
+        email_message = await asyncio.to_thread(fetch_email_message, user_credentials[user_id], uid)
+        if email_message is None:
+            await callback.answer("❌ Письмо не найдено", show_alert=True)
+            return
+
+        notification = build_email_notification(user_id, int(uid), email_message)
+        await send_notification(user_id, notification)
+        await callback.answer()
+    except Exception as e:
+        logging.error(f"Error showing email from digest: {str(e)}")
+        await callback.answer("❌ Произошла ошибка при отображении письма", show_alert=True)
+
+
+@dp.message(Command("digest"))
+async def cmd_digest(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in user_credentials:
+        await message.answer("Сначала авторизуйтесь с помощью /start.")
+        return
+
+    enabled = not user_credentials[user_id].get('digest')
+    user_credentials[user_id]['digest'] = enabled
+    save_user_credentials()
+
+    if enabled:
+        await message.answer(
+            f"✅ Режим сводки включен. Новые письма будут приходить одним сообщением "
+            f"раз в {DIGEST_WINDOW // 60} мин. Письма от VIP-отправителей (/vip) приходят сразу."
+        )
+    else:
+        await message.answer("✅ Режим сводки выключен. Каждое письмо будет приходить отдельным сообщением.")
+
+
+@dp.message(Command("vip"))
+async def cmd_vip(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in user_credentials:
+        await message.answer("Сначала авторизуйтесь с помощью /start.")
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        vip_senders = user_credentials[user_id].get('vip_senders') or []
+        await message.answer(
+            "VIP-отправители: " + (", ".join(vip_senders) if vip_senders else "не заданы") + "\n\n"
+            "Чтобы задать список, отправьте /vip boss@example.com @company.ru\n"
+            "Чтобы очистить список, отправьте /vip -"
+        )
+        return
+
+    vip_senders = [] if args == ['-'] else [arg.lower() for arg in args]
+    user_credentials[user_id]['vip_senders'] = vip_senders
+    save_user_credentials()
+    await message.answer("✅ Список VIP-отправителей обновлен.")
+
+
+@dp.message(Command("timezone"))
+async def cmd_timezone(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in user_credentials:
+        await message.answer("Сначала авторизуйтесь с помощью /start.")
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        current = user_credentials[user_id].get('timezone', DEFAULT_TIMEZONE)
+        await message.answer(
+            f"Текущий часовой пояс: {current}\n\n"
+            "Чтобы изменить его, отправьте, например, /timezone Asia/Yekaterinburg"
+        )
+        return
+
+    if not is_valid_timezone(args[0]):
+        await message.answer("❌ Неизвестный часовой пояс. Пример: Europe/Moscow")
+        return
+
+    user_credentials[user_id]['timezone'] = args[0]
+    save_user_credentials()
+    await message.answer(f"✅ Часовой пояс изменен на {args[0]}")
+
+
+def send_smtp_mail(email_addr, access_token, recipient, subject, body, message_id):
+    """Отправляет письмо через SMTP Яндекса (блокирующий вызов)"""
+    import smtplib
+    from email.mime.text import MIMEText
+
+    msg = MIMEText(body, _charset="utf-8")
+    msg['Subject'] = subject
+    msg['From'] = email_addr
+    msg['To'] = recipient
+    # Постоянный Message-ID позволяет получателю отбросить копию при повторной отправке
+    msg['Message-ID'] = message_id
+
+    with smtplib.SMTP_SSL('smtp.yandex.ru', 465) as server:
+        # Создаем строку аутентификации для XOAUTH2
+        auth_string = f"user={email_addr}\1auth=Bearer {access_token}\1\1"
+        auth_string = base64.b64encode(auth_string.encode()).decode()
+
+        # Для SMTP_SSL не нужен starttls, сразу аутентифицируемся
+        server.ehlo()
+        server.docmd('AUTH', f'XOAUTH2 {auth_string}')
+
+        # Отправляем письмо
+        server.sendmail(email_addr, [recipient], msg.as_string())
+
+
+async def deliver_mail(key: str, payload):
+    """Отправляет письмо из журнала и отмечает его отправленным"""
+    credentials = user_credentials[payload['user_id']]
+    domain = credentials['email'].rsplit('@', 1)[-1]
+    message_id = f"<{hashlib.sha1(key.encode()).hexdigest()}@{domain}>"
+    try:
+        await asyncio.to_thread(
+            send_smtp_mail, credentials['email'], credentials['access_token'],
+            payload['recipient'], payload['subject'], payload['body'], message_id
+        )
+    finally:
+        # Об ошибке пользователь узнает сразу, поэтому повторно такое письмо не отправляем
+        outbox.complete(key)
+
+
+def start_mail_delivery(key: str, payload):
+    """Запускает отправку письма так, чтобы остановка бота дождалась ее завершения"""
+    task = asyncio.create_task(deliver_mail(key, payload))
+    mail_deliveries.add(task)
+    task.add_done_callback(mail_deliveries.discard)
+    return task
+
+
+async def send_mail_from_chat(message: types.Message, recipient, subject, body, success_text, error_text):
+    """Записывает письмо в журнал, отправляет его и сообщает пользователю результат"""
+    user_id = message.from_user.id
+    key = f"mail:{user_id}:{message.message_id}"
+    payload = {
+        'user_id': user_id,
+        'recipient': recipient,
+        'subject': subject,
+        'body': body
+    }
+
+    if not outbox.add(key, 'mail', payload, sync=True):
+        return
+
+    try:
+        await asyncio.shield(start_mail_delivery(key, payload))
+        await message.answer(success_text)
+    except Exception as e:
+        logging.error(f"Error sending email: {str(e)}")
+        await message.answer(f"{error_text}: {e}")
+
+
 @dp.message(Command("send"))
 async def cmd_send(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
@@ -617,37 +1237,11 @@ async def process_body(message: types.Message, state: FSMContext):
     recipient = data['recipient']
     subject = data['subject']
     body = message.text.strip()
-    user_id = message.from_user.id
-
-    # Получаем email и токен
-    email_addr = user_credentials[user_id]['email']
-    access_token = user_credentials[user_id]['access_token']
-
-    import smtplib
-    from email.mime.text import MIMEText
-
-    msg = MIMEText(body, _charset="utf-8")
-    msg['Subject'] = subject
-    msg['From'] = email_addr
-    msg['To'] = recipient
-
-    try:
-        with smtplib.SMTP_SSL('smtp.yandex.ru', 465) as server:
-            # Создаем строку аутентификации для XOAUTH2
-            auth_string = f"user={email_addr}\1auth=Bearer {access_token}\1\1"
-            auth_string = base64.b64encode(auth_string.encode()).decode()
-
-            # Для SMTP_SSL не нужен starttls, сразу аутентифицируемся
-            server.ehlo()
-            server.docmd('AUTH', f'XOAUTH2 {auth_string}')
-
-            # Отправляем письмо
-            server.sendmail(email_addr, [recipient], msg.as_string())
-        await message.answer("✅ Письмо успешно отправлено!")
-    except Exception as e:
-        logging.error(f"Error sending email: {str(e)}")
-        await message.answer(f"❌ Не удалось отправить письмо: {e}")
 
+    await send_mail_from_chat(
+        message, recipient, subject, body,
+        "✅ Письмо успешно отправлено!", "❌ Не удалось отправить письмо"
+    )
     await state.clear()
 
 
@@ -685,41 +1279,113 @@ async def process_reply_body(message: types.Message, state: FSMContext):
     recipient = data['reply_to']
     subject = data['reply_subject']
     body = message.text.strip()
-    user_id = message.from_user.id
 
-    # Получаем email и токен
-    email_addr = user_credentials[user_id]['email']
-    access_token = user_credentials[user_id]['access_token']
+    await send_mail_from_chat(
+        message, recipient, subject, body,
+        "✅ Ответ успешно отправлен!", "❌ Не удалось отправить ответ"
+    )
+    await state.clear()
 
-    import smtplib
-    from email.mime.text import MIMEText
 
-    msg = MIMEText(body, _charset="utf-8")
-    msg['Subject'] = subject
-    msg['From'] = email_addr
-    msg['To'] = recipient
+async def replay_outbox():
+    """Доотправляет уведомления и письма, прерванные прошлой остановкой бота"""
+    for key, entry in list(outbox.pending.items()):
+        payload = entry['payload']
+        user_id = payload['user_id']
+        if user_id not in user_credentials:
+            outbox.complete(key)
+            continue
+
+        try:
+            if entry['kind'] == 'notification':
+                await deliver_notification(key, user_id, payload)
+            elif entry['kind'] == 'digest':
+                # Письмо возвращается в сводку и будет отмечено после ее отправки
+                add_to_digest(user_id, key, payload['item'])
+            elif entry['kind'] == 'mail':
+                # shield не даёт отмене восстановления при остановке бота оборвать уже начатую отправку
+                await asyncio.shield(start_mail_delivery(key, payload))
+                await bot.send_message(user_id, f"✅ Письмо для {payload['recipient']} отправлено после перезапуска бота.")
+        except Exception as e:
+            logging.error(f"Error replaying outbox entry {key}: {str(e)}")
+            if entry['kind'] == 'mail':
+                await bot.send_message(user_id, f"❌ Не удалось отправить письмо для {payload['recipient']}: {e}")
+
+    logging.info("Outbox replay finished")
+
+
+async def resume_work():
+    """Сначала доотправляет записи журнала, затем запускает проверку почты, чтобы они не пересекались"""
+    await replay_outbox()
+    await restore_watchers()
+
+
+async def on_startup():
+    """Запускается, когда бот готов принимать обновления"""
+    ready_in = time.perf_counter() - STARTUP_STARTED_AT
+    logging.info(f"Bot is ready to handle updates {ready_in:.2f} s after process start")
+    service_tasks['syncer'] = asyncio.create_task(outbox.run_syncer())
+    service_tasks['resume'] = asyncio.create_task(resume_work())
+
+
+async def flush_digests():
+    """Отправляет накопленные сводки всем пользователям"""
+    for user_id, credentials in list(user_credentials.items()):
+        if credentials.get('digest_pending'):
+            try:
+                await send_digest(user_id)
+            except Exception as e:
+                logging.error(f"Error sending digest to user {user_id} on shutdown: {str(e)}")
+
+
+async def on_shutdown():
+    """Останавливает работу по порядку: восстановление после запуска, проверка почты, сводки, отправка писем, журнал.
+
+    На все шаги вместе отводится SHUTDOWN_TIMEOUT секунд. Что не успело завершиться, остаётся в журнале
+    и будет доотправлено после следующего запуска.
+    """
+    logging.info("Shutting down, draining pending work")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT
+    shutdown_event.set()
+
+    # Восстановление могло ещё не закончиться: отменяем его, чтобы оно не запускало новую работу
+    resume_task = service_tasks.pop('resume', None)
+    if resume_task and not resume_task.done():
+        resume_task.cancel()
+        await asyncio.gather(resume_task, return_exceptions=True)
+
+    watchers = [task for task in watcher_tasks.values() if not task.done()]
+    if watchers:
+        await asyncio.wait(watchers, timeout=max(deadline - loop.time(), 0))
 
     try:
-        with smtplib.SMTP_SSL('smtp.yandex.ru', 465) as server:
-            # Создаем строку аутентификации для XOAUTH2
-            auth_string = f"user={email_addr}\1auth=Bearer {access_token}\1\1"
-            auth_string = base64.b64encode(auth_string.encode()).decode()
-
-            # Для SMTP_SSL не нужен starttls, сразу аутентифицируемся
-            server.ehlo()
-            server.docmd('AUTH', f'XOAUTH2 {auth_string}')
-
-            # Отправляем письмо
-            server.sendmail(email_addr, [recipient], msg.as_string())
-        await message.answer("✅ Ответ успешно отправлен!")
-    except Exception as e:
-        logging.error(f"Error sending reply: {str(e)}")
-        await message.answer(f"❌ Не удалось отправить ответ: {e}")
+        await asyncio.wait_for(flush_digests(), timeout=max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        logging.warning("Shutdown timeout reached while sending digests")
 
-    await state.clear()
+    if mail_deliveries:
+        await asyncio.wait(list(mail_deliveries), timeout=max(deadline - loop.time(), 0))
+
+    outbox.close()
+    syncer_task = service_tasks.pop('syncer', None)
+    if syncer_task:
+        syncer_task.cancel()
+        await asyncio.gather(syncer_task, return_exceptions=True)
+    logging.info("Shutdown complete")
 
 
 async def main():
+    load_user_credentials()
+    outbox.open()
+    # Письма, учтенные до остановки, не считаются новыми, а пришедшие за время простоя будут показаны
+    for user_id, mailbox_state in outbox.seen.items():
+        if user_id in user_credentials:
+            last_email_ids[user_id] = mailbox_state
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    # aiogram останавливает polling по SIGINT/SIGTERM, после чего вызывается on_shutdown
     await dp.start_polling(bot)
 
 
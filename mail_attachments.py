@@ -0,0 +1,264 @@
+import base64
+import binascii
+import os
+import re
+import tempfile
+from urllib.parse import unquote_to_bytes
+
+from mail_headers import decode_email_header
+
+# Размер одного частичного запроса к IMAP-серверу
+FETCH_CHUNK_SIZE = 256 * 1024
+
+# Максимальный размер файла, который бот может загрузить в Telegram
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+# Параметры RFC 2231: name* (закодированный), name*0, name*1* ... (продолжения)
+_RFC2231_PARAM_RE = re.compile(r'^(?P<name>[^*]+)\*(?:(?P<index>\d+)\*?)?$')
+
+
+def _flatten_response(data):
+    """Склеивает ответ imaplib в одну строку, заменяя литералы {n} строками в кавычках"""
+    result = b''
+    for item in data:
+        if isinstance(item, tuple):
+            header, literal = item
+            header = _LITERAL_RE.sub(b'', header)
+            escaped = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            result += header + b'"' + escaped + b'"'
+        elif item:
+            result += item
+    return result
+
+
+def _parse_sexp(raw):
+    """Разбирает IMAP-список в вложенные списки строк (NIL превращается в None)"""
+    stack = [[]]
+    pos = 0
+    while pos < len(raw):
+        match = _TOKEN_RE.match(raw, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        opening, closing, quoted, atom = match.groups()
+        if opening:
+            stack.append([])
+        elif closing:
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', errors='replace'))
+        elif atom.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(atom.decode('ascii', errors='replace'))
+    return stack[0]
+
+
+def _params_to_dict(params):
+    """Преобразует список параметров ("name" "value" ...) в словарь"""
+    if not isinstance(params, list):
+        return {}
+    return {str(params[i]).lower(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+
+
+def _decode_rfc2231(params, name):
+    """Собирает параметр RFC 2231 из частей name* или name*0*, name*1* ... и декодирует его"""
+    segments = []
+    for key, value in params.items():
+        match = _RFC2231_PARAM_RE.match(key)
+        if match and match.group('name') == name and value is not None:
+            segments.append((int(match.group('index') or 0), key.endswith('*'), value))
+    if not segments:
+        return None
+
+    segments.sort()
+    charset = 'utf-8'
+    data = b''
+    for position, (_, encoded, value) in enumerate(segments):
+        if not encoded:
+            data += value.encode('utf-8')
+            continue
+        # Первая закодированная часть начинается с charset'language'
+        if position == 0 and value.count("'") >= 2:
+            declared_charset, _, value = value.split("'", 2)
+            charset = declared_charset or charset
+        data += unquote_to_bytes(value)
+
+    # Части склеиваем до декодирования: многобайтный символ может оказаться на их границе
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def _decode_filename(params):
+    """Достаёт имя файла из параметров с учётом RFC 2231 и RFC 2047"""
+    filename = _decode_rfc2231(params, 'filename') or _decode_rfc2231(params, 'name')
+    if filename:
+        return filename
+    value = params.get('filename') or params.get('name')
+    if not value:
+        return None
+    return decode_email_header(value)
+
+
+def _walk_bodystructure(node, prefix, parts):
+    if node and isinstance(node[0], list):
+        # multipart: сначала идут вложенные части, потом подтип и расширения
+        index = 1
+        for child in node:
+            if not isinstance(child, list):
+                break
+            _walk_bodystructure(child, f"{prefix}.{index}" if prefix else str(index), parts)
+            index += 1
+        return
+
+    if len(node) < 7:
+        return
+
+    main_type = (node[0] or '').lower()
+    sub_type = (node[1] or '').lower()
+    body_params = _params_to_dict(node[2])
+    encoding = (node[5] or '7bit').lower()
+    size = int(node[6]) if str(node[6]).isdigit() else 0
+
+    # Позиция disposition зависит от типа части
+    if main_type == 'text':
+        disposition_index = 9
+    elif main_type == 'message' and sub_type == 'rfc822':
+        # После размера идут envelope, body, lines и md5
+        disposition_index = 11
+    else:
+        disposition_index = 8
+
+    disposition = None
+    disposition_params = {}
+    if len(node) > disposition_index and isinstance(node[disposition_index], list):
+        disposition = (node[disposition_index][0] or '').lower()
+        if len(node[disposition_index]) > 1:
+            disposition_params = _params_to_dict(node[disposition_index][1])
+
+    filename = _decode_filename({**body_params, **disposition_params})
+    if disposition == 'attachment' or filename:
+        parts.append({
+            'part': prefix or '1',
+            'filename': filename or f"attachment_{prefix or '1'}",
+            'content_type': f"{main_type}/{sub_type}",
+            'encoding': encoding,
+            'size': size,
+        })
+
+
+def list_attachments(imap, uid):
+    """Возвращает список вложений письма с указанным UID по BODYSTRUCTURE, не загружая само письмо"""
+    status, data = imap.uid('FETCH', uid, '(BODYSTRUCTURE)')
+    if status != 'OK':
+        raise RuntimeError(f"IMAP BODYSTRUCTURE fetch failed for UID {uid}")
+    if not data or data[0] is None:
+        return []
+
+    parsed = _parse_sexp(_flatten_response(data))
+    # Ответ имеет вид: <seq> (UID <uid> BODYSTRUCTURE (...))
+    for item in parsed:
+        if isinstance(item, list):
+            for i, value in enumerate(item[:-1]):
+                if isinstance(value, str) and value.upper() == 'BODYSTRUCTURE':
+                    parts = []
+                    _walk_bodystructure(item[i + 1], '', parts)
+                    return parts
+    return []
+
+
+class _Base64Decoder:
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, chunk):
+        self.buffer += b''.join(chunk.split())
+        usable = len(self.buffer) - len(self.buffer) % 4
+        decoded = base64.b64decode(self.buffer[:usable]) if usable else b''
+        self.buffer = self.buffer[usable:]
+        return decoded
+
+    def flush(self):
+        if not self.buffer:
+            return b''
+        return base64.b64decode(self.buffer + b'=' * (-len(self.buffer) % 4))
+
+
+class _QuotedPrintableDecoder:
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        # Декодируем только целые строки, чтобы не разорвать "=XX" или мягкий перенос
+        last_newline = self.buffer.rfind(b'\n')
+        if last_newline == -1:
+            return b''
+        complete, self.buffer = self.buffer[:last_newline + 1], self.buffer[last_newline + 1:]
+        return binascii.a2b_qp(complete)
+
+    def flush(self):
+        decoded = binascii.a2b_qp(self.buffer)
+        self.buffer = b''
+        return decoded
+
+
+class _IdentityDecoder:
+    def feed(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b''
+
+
+def _make_decoder(encoding):
+    if encoding == 'base64':
+        return _Base64Decoder()
+    if encoding == 'quoted-printable':
+        return _QuotedPrintableDecoder()
+    return _IdentityDecoder()
+
+
+def download_attachment(imap, uid, attachment):
+    """Скачивает вложение частями и декодирует его во временный файл.
+
+    Возвращает путь к файлу; удалить его должен вызывающий код.
+    """
+    decoder = _make_decoder(attachment['encoding'])
+    part = attachment['part']
+
+    fd, path = tempfile.mkstemp(prefix='mail_attachment_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            offset = 0
+            while True:
+                status, data = imap.uid('FETCH', uid, f'(BODY.PEEK[{part}]<{offset}.{FETCH_CHUNK_SIZE}>)')
+                if status != 'OK':
+                    raise RuntimeError(f"IMAP fetch failed for part {part}")
+
+                chunk = b''
+                for item in data:
+                    if isinstance(item, tuple):
+                        chunk = item[1]
+                        break
+
+                f.write(decoder.feed(chunk))
+                offset += len(chunk)
+                if len(chunk) < FETCH_CHUNK_SIZE:
+                    break
+
+                if f.tell() > TELEGRAM_UPLOAD_LIMIT:
+                    raise RuntimeError("Attachment is too large")
+
+            f.write(decoder.flush())
+    except Exception:
+        os.remove(path)
+        raise
+    return path
@@ -0,0 +1,169 @@
+import logging
+import re
+from datetime import timezone
+from email.charset import UNKNOWN8BIT
+from email.header import Header, decode_header
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Сколько различных значений заголовков и дат держать в кэше
+HEADER_CACHE_SIZE = 4096
+DATE_CACHE_SIZE = 4096
+
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+
+# Кодировки, которые пробуем, если указанная в заголовке неизвестна или не подходит
+FALLBACK_CHARSETS = ('utf-8', 'cp1251', 'koi8-r')
+
+# Байты 0x80-0xff, которые email сохраняет в строке как суррогаты при разборе 8-битных заголовков
+_SURROGATE_RE = re.compile('[\udc80-\udcff]')
+
+# Названия дней недели и месяцев, индексируются по datetime.weekday() и datetime.month
+DAYS = (
+    'Понедельник',
+    'Вторник',
+    'Среда',
+    'Четверг',
+    'Пятница',
+    'Суббота',
+    'Воскресенье'
+)
+
+MONTHS = (
+    None,
+    'Января',
+    'Февраля',
+    'Марта',
+    'Апреля',
+    'Мая',
+    'Июня',
+    'Июля',
+    'Августа',
+    'Сентября',
+    'Октября',
+    'Ноября',
+    'Декабря'
+)
+
+
+def _decode_bytes(data, charset):
+    """Декодирует байты в указанной кодировке, при ошибке перебирает запасные"""
+    if charset:
+        try:
+            return data.decode(charset)
+        except (LookupError, UnicodeDecodeError):
+            pass
+
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+
+    # cp1251 и koi8-r декодируют почти любые байты, поэтому выбираем вариант,
+    # в котором больше строчных букв: в обычном тексте их большинство
+    candidates = []
+    for candidate in FALLBACK_CHARSETS[1:]:
+        try:
+            candidates.append(data.decode(candidate))
+        except UnicodeDecodeError:
+            continue
+    if candidates:
+        return max(candidates, key=lambda text: sum(ch.islower() for ch in text))
+    return data.decode('utf-8', errors='replace')
+
+
+def _decode_8bit(text):
+    """Подбирает кодировку для сырых 8-битных байтов, сохранённых как суррогаты"""
+    if not _SURROGATE_RE.search(text):
+        return text
+    return _decode_bytes(text.encode('utf-8', 'surrogateescape'), None)
+
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _decode_header_cached(raw):
+    decoded = []
+    try:
+        parts = decode_header(raw)
+    except Exception:
+        return _decode_8bit(raw)
+
+    for part, charset in parts:
+        if isinstance(part, bytes):
+            if charset is None:
+                # Текст вне encoded-word decode_header возвращает в raw-unicode-escape
+                part = part.decode('raw-unicode-escape')
+            else:
+                part = _decode_bytes(part, charset)
+        decoded.append(_decode_8bit(part))
+    return ''.join(decoded)
+
+
+def _header_to_str(header):
+    """Возвращает исходный текст Header, в котором 8-битные байты сохранены как суррогаты"""
+    chunks = []
+    for part, charset in decode_header(header.encode(maxlinelen=0)):
+        if isinstance(part, str):
+            chunks.append(part)
+        elif charset in (None, UNKNOWN8BIT):
+            chunks.append(part.decode('ascii', 'surrogateescape'))
+        else:
+            chunks.append(_decode_bytes(part, charset))
+    return ''.join(chunks)
+
+
+def decode_email_header(header):
+    """Декодирует заголовок письма"""
+    if header is None:
+        return ''
+    if isinstance(header, Header):
+        # Заголовки с 8-битными байтами приходят как Header с кодировкой unknown-8bit.
+        # str() заменил бы байты на U+FFFD, поэтому восстанавливаем исходный текст:
+        # encoded-word внутри него декодируются, а остальные 8-битные байты идут в подбор кодировки
+        return _decode_header_cached(_header_to_str(header))
+    return _decode_header_cached(str(header))
+
+
+@lru_cache(maxsize=None)
+def _get_zone(tz_name):
+    try:
+        return ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logging.warning(f"Unknown timezone {tz_name}, using UTC")
+        return timezone.utc
+
+
+def is_valid_timezone(tz_name):
+    """Проверяет, что часовой пояс известен системе"""
+    try:
+        ZoneInfo(tz_name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _format_email_date_cached(date_str, tz_name):
+    if not date_str:
+        return 'Дата неизвестна'
+
+    try:
+        date = parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError) as e:
+        logging.error(f"Error formatting date {date_str}: {str(e)}")
+        return date_str
+
+    # Дата без часового пояса (или с -0000) считается указанной в UTC
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    date = date.astimezone(_get_zone(tz_name))
+
+    return f"{DAYS[date.weekday()]}, {date.day} {MONTHS[date.month]} {date.year}, {date:%H:%M}"
+
+
+def format_email_date(date, tz_name=DEFAULT_TIMEZONE):
+    """Форматирует дату письма в русский формат в часовом поясе пользователя"""
+    if isinstance(date, Header):
+        # Header с 8-битными байтами нельзя положить в кэш, поэтому сначала декодируем его в строку
+        date = decode_email_header(date)
+    return _format_email_date_cached(str(date) if date else None, tz_name)
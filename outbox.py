@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+# Сколько записей копить перед fsync и как долго их можно держать несинхронизированными
+OUTBOX_FSYNC_BATCH = 32
+OUTBOX_FSYNC_INTERVAL = 0.5
+
+# Сколько ключей уже доставленных сообщений помнить для защиты от повторов
+OUTBOX_DONE_KEYS_LIMIT = 10000
+
+# После скольких дописанных записей журнал сжимается, не дожидаясь перезапуска
+OUTBOX_COMPACT_RECORDS = 2 * OUTBOX_DONE_KEYS_LIMIT
+
+
+class Outbox:
+    """Журнал исходящих уведомлений и писем, который переживает перезапуск бота.
+
+    Файл пишется только дописыванием строк JSON:
+      {"op": "add", "key": ..., "kind": ..., "payload": {...}} - сообщение ждёт отправки
+      {"op": "done", "key": ...}                                 - сообщение отправлено
+      {"op": "seen", "user_id": ..., "uidvalidity": ..., "last_uid": ...} - последнее учтённое письмо
+    При открытии и после OUTBOX_COMPACT_RECORDS записей журнал сжимается до незавершённых записей.
+    Каждая запись сразу передаётся ОС, поэтому переживает падение процесса; пачками выполняется
+    только fsync, который защищает от отключения питания. В журнале лежат тексты писем и адреса,
+    поэтому файл доступен только владельцу.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = OrderedDict()  # key -> {'kind': ..., 'payload': ...}
+        self.done = OrderedDict()  # key -> None, последние доставленные ключи
+        self.seen = {}  # user_id -> (UIDVALIDITY, последний учтённый UID)
+        self._file = None
+        self._unsynced = 0
+        self._appended = 0  # Записей, дописанных после последнего сжатия
+        self._last_sync = time.monotonic()
+
+    def open(self):
+        """Перечитывает журнал, сжимает его и открывает на дозапись"""
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        # Последняя строка могла не дописаться при аварийной остановке
+                        logging.warning(f"Skipping damaged outbox record: {line[:100]!r}")
+
+        self._compact()
+        self._file = self._open_private(self.path, os.O_APPEND)
+        logging.info(f"Outbox opened: {len(self.pending)} pending entries")
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'add':
+            if record['key'] not in self.done:
+                self.pending[record['key']] = {'kind': record['kind'], 'payload': record['payload']}
+        elif op == 'done':
+            self.pending.pop(record['key'], None)
+            self._remember_done(record['key'])
+        elif op == 'seen':
+            self.seen[int(record['user_id'])] = (record['uidvalidity'], record['last_uid'])
+
+    def _remember_done(self, key):
+        self.done[key] = None
+        self.done.move_to_end(key)
+        while len(self.done) > OUTBOX_DONE_KEYS_LIMIT:
+            self.done.popitem(last=False)
+
+    @staticmethod
+    def _open_private(path, flags):
+        # Права задаются только при создании файла; старый журнал с другими правами
+        # заменяется при сжатии файлом, созданным заново
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600)
+        return os.fdopen(fd, 'a' if flags & os.O_APPEND else 'w', encoding='utf-8')
+
+    def _compact(self):
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with self._open_private(tmp_path, os.O_TRUNC) as f:
+            for key in self.done:
+                f.write(json.dumps({'op': 'done', 'key': key}, ensure_ascii=False) + '\n')
+            for user_id, (uidvalidity, last_uid) in self.seen.items():
+                record = {'op': 'seen', 'user_id': user_id, 'uidvalidity': uidvalidity, 'last_uid': last_uid}
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            for key, entry in self.pending.items():
+                record = {'op': 'add', 'key': key, 'kind': entry['kind'], 'payload': entry['payload']}
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _write(self, record, sync=False):
+        if self._file is None:
+            # Журнал уже закрыт при остановке: запись останется только в памяти
+            logging.warning(f"Outbox is closed, dropping record {record.get('op')} {record.get('key', '')}")
+            return
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        self._appended += 1
+        if self._appended >= OUTBOX_COMPACT_RECORDS:
+            self._rewrite()
+        elif sync or self._unsynced >= OUTBOX_FSYNC_BATCH:
+            self.sync()
+
+    def _rewrite(self):
+        """Сжимает журнал во время работы, чтобы он не рос вместе с объемом почты"""
+        self._file.close()
+        self._compact()
+        self._file = self._open_private(self.path, os.O_APPEND)
+        self._unsynced = 0
+        self._appended = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        """Сбрасывает накопленные записи на диск"""
+        if self._file is None or not self._unsynced:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    async def run_syncer(self):
+        """Периодически сбрасывает журнал на диск, чтобы записи не ждали заполнения пачки"""
+        while self._file is not None:
+            await asyncio.sleep(OUTBOX_FSYNC_INTERVAL)
+            if self._unsynced and time.monotonic() - self._last_sync >= OUTBOX_FSYNC_INTERVAL:
+                self.sync()
+
+    def is_known(self, key):
+        """Проверяет, записано ли уже сообщение с таким ключом"""
+        return key in self.pending or key in self.done
+
+    def add(self, key, kind, payload, sync=False):
+        """Записывает сообщение, ожидающее отправки. Возвращает False, если ключ уже известен"""
+        if self.is_known(key):
+            return False
+        self.pending[key] = {'kind': kind, 'payload': payload}
+        self._write({'op': 'add', 'key': key, 'kind': kind, 'payload': payload}, sync=sync)
+        return True
+
+    def complete(self, key):
+        """Отмечает сообщение как отправленное"""
+        self.pending.pop(key, None)
+        self._remember_done(key)
+        self._write({'op': 'done', 'key': key})
+
+    def checkpoint(self, user_id, uidvalidity, last_uid):
+        """Запоминает последнее письмо, которое уже учтено для пользователя"""
+        if self.seen.get(user_id) == (uidvalidity, last_uid):
+            return
+        self.seen[user_id] = (uidvalidity, last_uid)
+        self._write({'op': 'seen', 'user_id': user_id, 'uidvalidity': uidvalidity, 'last_uid': last_uid})
+
+    def close(self):
+        """Сбрасывает журнал на диск и закрывает файл"""
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
@@ -0,0 +1,91 @@
+import base64
+import binascii
+import os
+
+import mail_attachments
+from mail_attachments import _Base64Decoder, _QuotedPrintableDecoder, download_attachment, list_attachments
+
+
+class FakeImap:
+    """Отдаёт заранее заготовленные ответы на UID FETCH"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.queries = []
+
+    def uid(self, command, uid, query):
+        self.queries.append(query)
+        return self.responses(query) if callable(self.responses) else self.responses
+
+
+def test_list_attachments_rfc2231_filenames():
+    data = [
+        b'7 (UID 42 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 12 1 NIL NIL NIL NIL)'
+        b'("application" "pdf" ("name" "report.pdf") NIL NIL "base64" 1000 NIL '
+        b'("attachment" ("filename*" "utf-8\'\'%D0%9E%D1%82%D1%87%D1%91%D1%82.pdf")) NIL NIL)'
+        b'("image" "png" NIL NIL NIL "base64" 500 NIL '
+        b'("attachment" ("filename*0*" "utf-8\'\'%D0%A4%D0" "filename*1*" "%BE%D1%82%D0%BE" "filename*2" ".png")) NIL NIL)'
+        b' "mixed" ("boundary" "xyz") NIL NIL NIL))'
+    ]
+    attachments = list_attachments(FakeImap(('OK', data)), '42')
+    assert [(a['part'], a['filename'], a['encoding']) for a in attachments] == [
+        ('2', 'Отчёт.pdf', 'base64'),
+        ('3', 'Фото.png', 'base64'),
+    ]
+
+
+def test_list_attachments_rfc822_with_literal():
+    data = [
+        (b'3 (UID 9 BODYSTRUCTURE (("text" "plain" NIL NIL NIL "7bit" 5 1 NIL NIL NIL NIL)'
+         b'("message" "rfc822" NIL NIL NIL "7bit" 300 (NIL {7}', b'Hi "you'),
+        b' NIL NIL NIL NIL NIL NIL NIL NIL) ("text" "plain" NIL NIL NIL "7bit" 5 1) 10 NIL '
+        b'("attachment" ("filename" "forward.eml")) NIL NIL) "mixed" NIL NIL NIL NIL))',
+    ]
+    attachments = list_attachments(FakeImap(('OK', data)), '9')
+    assert [(a['part'], a['filename'], a['content_type']) for a in attachments] == [
+        ('2', 'forward.eml', 'message/rfc822'),
+    ]
+
+
+def test_list_attachments_failed_fetch_raises():
+    try:
+        list_attachments(FakeImap(('NO', [b'error'])), '1')
+    except RuntimeError:
+        return
+    raise AssertionError("failed fetch must not look like a message without attachments")
+
+
+def test_base64_decoder_handles_arbitrary_chunks():
+    payload = os.urandom(1000)
+    encoded = base64.encodebytes(payload)
+    decoder = _Base64Decoder()
+    decoded = b''.join(decoder.feed(encoded[i:i + 7]) for i in range(0, len(encoded), 7)) + decoder.flush()
+    assert decoded == payload
+
+
+def test_quoted_printable_decoder_handles_split_escapes():
+    payload = 'Привет, мир! '.encode('utf-8') * 20
+    encoded = binascii.b2a_qp(payload)
+    decoder = _QuotedPrintableDecoder()
+    decoded = b''.join(decoder.feed(encoded[i:i + 5]) for i in range(0, len(encoded), 5)) + decoder.flush()
+    assert decoded == payload
+
+
+def test_download_attachment_in_chunks(monkeypatch):
+    monkeypatch.setattr(mail_attachments, 'FETCH_CHUNK_SIZE', 16)
+    payload = os.urandom(100)
+    encoded = base64.encodebytes(payload)
+
+    def respond(query):
+        offset = int(query.split('<')[1].split('.')[0])
+        chunk = encoded[offset:offset + 16]
+        return 'OK', [(b'1 (UID 5 BODY[2]<%d> {%d}' % (offset, len(chunk)), chunk), b')']
+
+    imap = FakeImap(respond)
+    path = download_attachment(imap, '5', {'part': '2', 'encoding': 'base64'})
+    try:
+        with open(path, 'rb') as f:
+            assert f.read() == payload
+    finally:
+        os.remove(path)
+    assert all(query.startswith('(BODY.PEEK[2]<') for query in imap.queries)
@@ -0,0 +1,26 @@
+import email
+
+from mail_headers import decode_email_header, format_email_date
+
+ENCODED_REPORT = '=?utf-8?Q?=D0=9E=D1=82=D1=87=D1=91=D1=82?='
+
+
+def test_encoded_word_mixed_with_raw_unicode():
+    assert decode_email_header(f'Re: Fwd: {ENCODED_REPORT} за неделю') == 'Re: Fwd: Отчёт за неделю'
+
+
+def test_encoded_word_mixed_with_raw_8bit_bytes():
+    for charset in ('utf-8', 'cp1251', 'koi8-r'):
+        message = email.message_from_bytes(f'Subject: Re: {ENCODED_REPORT} за неделю\n\n'.encode(charset))
+        assert decode_email_header(message['subject']) == 'Re: Отчёт за неделю'
+
+
+def test_raw_8bit_header_without_encoded_words():
+    message = email.message_from_bytes('Subject: Привет, мир\n\n'.encode('cp1251'))
+    assert decode_email_header(message['subject']) == 'Привет, мир'
+
+
+def test_date_header_with_8bit_bytes():
+    message = email.message_from_bytes('Date: Mon, 5 Feb 2024 10:30:00 +0300 (Москва)\n\n'.encode('utf-8'))
+    assert format_email_date(message['date']) == 'Понедельник, 5 Февраля 2024, 10:30'
+    assert format_email_date(None) == 'Дата неизвестна'